@@ -1,3 +1,4 @@
+from functools import cached_property
 from typing import Optional
 
 from pydantic_settings import BaseSettings
@@ -21,17 +22,36 @@ class Settings(BaseSettings):
     # 共通
     QDRANT_COLLECTION: str = "who_diabetes_guideline"
 
+    # 埋め込みキャッシュ (SQLite)。空文字にすると無効
+    EMBED_CACHE_PATH: Optional[str] = ".cache/embeddings.sqlite3"
+    # カテゴリ分類結果のキャッシュ (diskcache ディレクトリ)。空文字にすると無効
+    CLASSIFY_CACHE_DIR: Optional[str] = ".cache/cls"
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
 
+    @cached_property
     def qdrant_mode(self) -> str:
-        """cloud / local を判定"""
+        """cloud / local を判定（初回のみ）"""
         if self.QDRANT_URL is not None:
             return "cloud"
         if self.QDRANT_PATH is not None:
             return "local"
         raise ValueError("Set either QDRANT_URL (cloud) or QDRANT_PATH (local).")
 
+    # SecretStr / AnyUrl の展開も1回だけ
+    @cached_property
+    def openai_api_key(self) -> str:
+        return self.OPENAI_API_KEY.get_secret_value()
+
+    @cached_property
+    def qdrant_url(self) -> str | None:
+        return str(self.QDRANT_URL) if self.QDRANT_URL else None
+
+    @cached_property
+    def qdrant_api_key(self) -> str | None:
+        return self.QDRANT_API_KEY.get_secret_value() if self.QDRANT_API_KEY else None
+
 
 settings = Settings()
@@ -1,69 +1,207 @@
-from typing import List
-from contextlib import asynccontextmanager
+import asyncio
+import multiprocessing
+import sqlite3
+from typing import AsyncIterator, List
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
 from pathlib import Path
-from pydantic import BaseModel
-from fastapi import APIRouter, FastAPI, HTTPException
-from openai import OpenAI
-from qdrant_client import QdrantClient
-import uuid
+from pydantic import BaseModel, Field
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import httpx
+from diskcache import Cache
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
+from qdrant_client import AsyncQdrantClient, QdrantClient
+import numpy as np
+import orjson
+import xxhash
 from datetime import datetime, timezone
 
 from config import settings
 from services.pdf_service import extract_pages, pages_to_chunks
-from services.embeddings_service import detect_embedding_dim, embed_texts, embed_text
-from services.qdrant_service import create_qdrant_client, delete_by_source, ensure_collection, upsert_chunks, search_similar
-from services.answer_service import generate_answer
-
-
-DOC_PAGES: List[dict] = []
-QDRANT_CLIENT: QdrantClient | None = None
-QDRANT_MODE: str | None = None
-OPENAI_CLIENT: OpenAI | None = None
-EMBED_DIM: int | None = None
+from services.embed_cache import open_cache
+from services.embeddings_service import (
+    detect_embedding_dim,
+    embed_query,
+    embed_texts,
+    fetch_embedding_batch_results,
+    submit_embedding_batch,
+)
+from services.qdrant_service import (
+    create_async_qdrant_client,
+    create_qdrant_client,
+    delete_by_source,
+    ensure_collection,
+    ensure_payload_indexes,
+    latest_ingested_at,
+    list_sources,
+    search_similar,
+    upsert_chunks,
+    upsert_chunks_async,
+)
+from services.answer_service import generate_answer, stream_answer
 
 
 @asynccontextmanager
-async def lifespan(app: FastAPI):
-    global QDRANT_CLIENT, QDRANT_MODE, OPENAI_CLIENT, EMBED_DIM
-
-    # --- startup（起動時に1回）---
-    mode = settings.qdrant_mode()
-    QDRANT_CLIENT, QDRANT_MODE = create_qdrant_client(
+async def qdrant_lifespan(app: FastAPI):
+    state = app.state
+    mode = settings.qdrant_mode
+    state.qdrant, state.qdrant_mode = create_qdrant_client(
         mode=mode,
-        url=str(settings.QDRANT_URL) if settings.QDRANT_URL else None,
-        api_key=settings.QDRANT_API_KEY.get_secret_value() if settings.QDRANT_API_KEY else None,
+        url=settings.qdrant_url,
+        api_key=settings.qdrant_api_key,
         path=settings.QDRANT_PATH,
     )
+    # cloud のみ（local は同じ storage を別クライアントで開けない）
+    state.async_qdrant = create_async_qdrant_client(mode=mode, url=settings.qdrant_url, api_key=settings.qdrant_api_key)
+    try:
+        yield
+    finally:
+        if state.async_qdrant is not None:
+            await state.async_qdrant.close()
+        state.qdrant.close()
+        state.qdrant = state.async_qdrant = state.qdrant_mode = None
 
-    QDRANT_CLIENT.get_collections()
-
-    OPENAI_CLIENT = OpenAI(api_key=settings.OPENAI_API_KEY.get_secret_value())
+@asynccontextmanager
+async def openai_lifespan(app: FastAPI):
+    state = app.state
+    state.openai = OpenAI(api_key=settings.openai_api_key)
+    # 接続プールを広げ、HTTP/2 で embed / responses の同時リクエストを1本の TLS 接続に多重化
+    state.async_openai = AsyncOpenAI(
+        api_key=settings.openai_api_key,
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            timeout=httpx.Timeout(120.0, connect=5.0),
+        ),
+    )
+    try:
+        yield
+    finally:
+        await state.async_openai.close()
+        state.openai.close()
+        state.openai = state.async_openai = None
 
+@asynccontextmanager
+async def collection_lifespan(app: FastAPI):
+    state = app.state
+    # ensure_collection / get_collection が最初の Qdrant 呼び出し（warmup 用の get_collections は不要）
     # Prefer existing collection dim to avoid unnecessary OpenAI calls (offline-safe for history view)
-    if QDRANT_CLIENT.collection_exists(settings.QDRANT_COLLECTION):
-        info = QDRANT_CLIENT.get_collection(settings.QDRANT_COLLECTION)
-        EMBED_DIM = info.config.params.vectors.size
+    # local モードは payload index を使わず payload_schema も常に空なので、作成しない（毎回の警告を避ける）
+    payload_indexes = state.qdrant_mode != "local"
+    if state.qdrant.collection_exists(settings.QDRANT_COLLECTION):
+        info = state.qdrant.get_collection(settings.QDRANT_COLLECTION)
+        state.embed_dim = info.config.params.vectors.size
+        if payload_indexes:
+            ensure_payload_indexes(state.qdrant, settings.QDRANT_COLLECTION, existing=info.payload_schema)
     else:
-        EMBED_DIM = detect_embedding_dim(OPENAI_CLIENT, settings.OPENAI_EMBEDDING_MODEL)
-        ensure_collection(QDRANT_CLIENT, settings.QDRANT_COLLECTION, EMBED_DIM)
+        state.embed_dim = detect_embedding_dim(state.openai, settings.OPENAI_EMBEDDING_MODEL)
+        ensure_collection(
+            state.qdrant, settings.QDRANT_COLLECTION, state.embed_dim, payload_indexes=payload_indexes
+        )
+    state.doc_pages = []
+    try:
+        yield
+    finally:
+        state.embed_dim = None
+        state.doc_pages = []
 
-    yield
+@asynccontextmanager
+async def pdf_pool_lifespan(app: FastAPI):
+    # PDF テキスト抽出用のプロセスプール（uvicorn --workers N ならワーカーごとに1つ）
+    # スレッド（threadpool / httpx）が動いているサーバーから fork すると子がロックを掴んだまま固まりうるので、
+    # forkserver（Windows には無いので spawn）で起動する（子は services.pdf_service だけ import すればよい）
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    app.state.pdf_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+    try:
+        yield
+    finally:
+        app.state.pdf_pool.shutdown(cancel_futures=True)
+        app.state.pdf_pool = None
 
-    # --- shutdown（終了時に1回）---
-    QDRANT_CLIENT = None
-    OPENAI_CLIENT = None
-    EMBED_DIM = None
-    QDRANT_MODE = None
+@asynccontextmanager
+async def embed_cache_lifespan(app: FastAPI):
+    # 再 ingest で変わっていないチャンクは埋め込みを再計算しない（WAL なので複数ワーカーでも共有可）
+    path = settings.EMBED_CACHE_PATH
+    app.state.embed_cache = open_cache(path) if path else None
+    try:
+        yield
+    finally:
+        if app.state.embed_cache is not None:
+            app.state.embed_cache.close()
+        app.state.embed_cache = None
 
+@asynccontextmanager
+async def classify_cache_lifespan(app: FastAPI):
+    # 同じ質問 + 同じ根拠ならカテゴリ分類の LLM 呼び出しを省く（eval / 回帰テストの繰り返し向け）
+    path = settings.CLASSIFY_CACHE_DIR
+    app.state.classify_cache = Cache(path) if path else None
+    try:
+        yield
+    finally:
+        if app.state.classify_cache is not None:
+            app.state.classify_cache.close()
+        app.state.classify_cache = None
+
+# 起動順に enter / 逆順に exit（auth / metrics などはここに追加）
+SUB_LIFESPANS = (
+    qdrant_lifespan,
+    openai_lifespan,
+    collection_lifespan,
+    pdf_pool_lifespan,
+    embed_cache_lifespan,
+    classify_cache_lifespan,
+)
 
-app = FastAPI(title="Diabetes Guideline Assistant", lifespan=lifespan)
+@asynccontextmanager
+async def merged_lifespan(app: FastAPI):
+    async with AsyncExitStack() as stack:
+        for sub in SUB_LIFESPANS:
+            await stack.enter_async_context(sub(app))
+        yield
+
+
+app = FastAPI(
+    title="Diabetes Guideline Assistant",
+    lifespan=merged_lifespan,
+    default_response_class=ORJSONResponse,
+)
 api = APIRouter(prefix="/api")
 
+# ---- Dependencies（lifespan が app.state に載せたものを取り出す）----
+def get_qdrant(request: Request) -> QdrantClient:
+    return request.app.state.qdrant
+
+def get_async_qdrant(request: Request) -> AsyncQdrantClient | None:
+    return request.app.state.async_qdrant
+
+def get_qdrant_mode(request: Request) -> str:
+    return request.app.state.qdrant_mode
+
+def get_openai(request: Request) -> OpenAI:
+    return request.app.state.openai
+
+def get_async_openai(request: Request) -> AsyncOpenAI:
+    return request.app.state.async_openai
+
+def get_embed_dim(request: Request) -> int:
+    return request.app.state.embed_dim
+
+def get_pdf_pool(request: Request) -> ProcessPoolExecutor:
+    return request.app.state.pdf_pool
+
+def get_embed_cache(request: Request) -> sqlite3.Connection | None:
+    return request.app.state.embed_cache
+
+def get_classify_cache(request: Request) -> Cache | None:
+    return request.app.state.classify_cache
+
 @api.get("/health")
 def health():
     return {
         "status": "ok",
-        "qdrant_mode": settings.qdrant_mode(),
+        "qdrant_mode": settings.qdrant_mode,
         "collection": settings.QDRANT_COLLECTION,
         "embedding_model": settings.OPENAI_EMBEDDING_MODEL,
     }
@@ -71,21 +209,71 @@ def health():
 class IngestRequest(BaseModel):
     pdf_path: str
 
-@api.post("/ingest")
-def ingest(req: IngestRequest):
-    global DOC_PAGES
-    if QDRANT_CLIENT is None or OPENAI_CLIENT is None or EMBED_DIM is None:
-        raise HTTPException(status_code=500, detail="Services not initialized")
+# Qdrant payload に保存する本文の上限（埋め込みは全文から計算）
+PAYLOAD_TEXT_MAX = 800
 
-    # 1) PDF → pages
-    DOC_PAGES = extract_pages(req.pdf_path)
+def chunk_key(src: str, page: int, chunk_index: int) -> str:
+    return f"{src}|p{page}|c{chunk_index}"
+
+def parse_chunk_key(key: str) -> tuple[str, int, int]:
+    src, page, chunk_index = key.rsplit("|", 2)
+    return src, int(page[1:]), int(chunk_index[1:])
+
+def chunk_point_ids(src: str, chunks: List[dict]) -> list[int]:
+    # u64 point id = xxh3_64(chunk_key)（UUID 文字列より軽く、MD5/SHA-1 も不要）
+    return [xxhash.xxh3_64_intdigest(chunk_key(src, c["page"], c["chunk_index"])) for c in chunks]
 
-    # 2) pages → chunks
-    chunks = pages_to_chunks(DOC_PAGES, chunk_size=1000, overlap=150)
+def build_points(src: str, chunks: List[dict], ingested_at: str, **extra_payload) -> tuple[list[int], list[dict]]:
+    ids = chunk_point_ids(src, chunks)
+    payloads = [
+        {
+            "source": src,
+            "page": c["page"],
+            "chunk_index": c["chunk_index"],
+            "chunk_key": chunk_key(src, c["page"], c["chunk_index"]),
+            "text": c["text"].strip()[:PAYLOAD_TEXT_MAX],
+            "ingested_at": ingested_at,
+            **extra_payload,
+        }
+        for c in chunks
+    ]
+    return ids, payloads
+
+async def upsert_points(
+    qdrant: QdrantClient,
+    async_qdrant: AsyncQdrantClient | None,
+    ids: list[int],
+    vectors: np.ndarray | list[list[float]],
+    payloads: list[dict],
+) -> None:
+    if async_qdrant is not None:
+        await upsert_chunks_async(async_qdrant, settings.QDRANT_COLLECTION, ids, vectors, payloads)
+    else:
+        await run_in_threadpool(upsert_chunks, qdrant, settings.QDRANT_COLLECTION, ids, vectors, payloads)
+
+@api.post("/ingest")
+async def ingest(
+    req: IngestRequest,
+    request: Request,
+    qdrant: QdrantClient = Depends(get_qdrant),
+    async_qdrant: AsyncQdrantClient | None = Depends(get_async_qdrant),
+    async_openai: AsyncOpenAI = Depends(get_async_openai),
+    pdf_pool: ProcessPoolExecutor = Depends(get_pdf_pool),
+    embed_cache: sqlite3.Connection | None = Depends(get_embed_cache),
+):
+    # 1) PDF → pages
+    pages = await run_in_threadpool(extract_pages, req.pdf_path, pdf_pool)
+    request.app.state.doc_pages = pages
+
+    # 2) pages → chunks（CPU 処理なのでイベントループの外で）
+    chunks = await run_in_threadpool(pages_to_chunks, pages, chunk_size=1000, overlap=150)
+    # テキストが取れない PDF（画像のみ / スキャン）は upsert も古いチャンクの削除もしない
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No text extracted from PDF")
     texts = [c["text"] for c in chunks]
 
     # 3) embeddings（まとめて）
-    vectors = embed_texts(OPENAI_CLIENT, settings.OPENAI_EMBEDDING_MODEL, texts)
+    vectors = await embed_texts(async_openai, settings.OPENAI_EMBEDDING_MODEL, texts, cache=embed_cache)
     if len(vectors) != len(texts):
         raise HTTPException(status_code=500, detail="Embedding count mismatch")
 
@@ -94,75 +282,110 @@ def ingest(req: IngestRequest):
 
     # 4) Qdrant upsert
     src = Path(req.pdf_path).name
-    ids = [
-        str(uuid.uuid5(uuid.NAMESPACE_URL, f"{src}|p{c['page']}|c{c['chunk_index']}"))
-        for c in chunks
-    ]
-    payloads = [
-        {
-            "source": src,
-            "page": c["page"],
-            "chunk_index": c["chunk_index"],
-            "text": c["text"],
-            "ingested_at": ingested_at,
+    ids, payloads = build_points(src, chunks, ingested_at)
+    await upsert_points(qdrant, async_qdrant, ids, vectors, payloads)
+
+    # 5) 同じ source の古いチャンク（旧IDやページ数減少分）を削除
+    await run_in_threadpool(delete_by_source, qdrant, settings.QDRANT_COLLECTION, src, keep_ids=ids)
+
+    return {"ok": True, "pages": len(pages), "chunks": len(chunks)}
+
+# ---- Batch API ingest（大きなPDF向け：非同期・低コスト）----
+@api.post("/ingest/batch")
+async def ingest_batch(
+    req: IngestRequest,
+    async_openai: AsyncOpenAI = Depends(get_async_openai),
+    pdf_pool: ProcessPoolExecutor = Depends(get_pdf_pool),
+):
+    pages = await run_in_threadpool(extract_pages, req.pdf_path, pdf_pool)
+    chunks = await run_in_threadpool(pages_to_chunks, pages, chunk_size=1000, overlap=150)
+    if not chunks:
+        raise HTTPException(status_code=400, detail="No text extracted from PDF")
+
+    src = Path(req.pdf_path).name
+    items = [(chunk_key(src, c["page"], c["chunk_index"]), c["text"]) for c in chunks]
+    batch = await submit_embedding_batch(
+        async_openai,
+        settings.OPENAI_EMBEDDING_MODEL,
+        items,
+        metadata={"source": src},
+    )
+
+    return {"ok": True, "batch_id": batch.id, "status": batch.status, "pages": len(pages), "chunks": len(chunks)}
+
+@api.get("/ingest/batch/{batch_id}")
+async def ingest_batch_status(
+    batch_id: str,
+    qdrant: QdrantClient = Depends(get_qdrant),
+    async_qdrant: AsyncQdrantClient | None = Depends(get_async_qdrant),
+    async_openai: AsyncOpenAI = Depends(get_async_openai),
+):
+    batch = await async_openai.batches.retrieve(batch_id)
+    counts = batch.request_counts.model_dump() if batch.request_counts else None
+    if batch.status != "completed":
+        return {
+            "ok": batch.status not in ("failed", "expired", "cancelling", "cancelled"),
+            "batch_id": batch.id,
+            "status": batch.status,
+            "request_counts": counts,
+            "chunks": 0,
         }
-        for c in chunks
-    ]
-    upsert_chunks(QDRANT_CLIENT, settings.QDRANT_COLLECTION, ids, vectors, payloads)
 
-    return {"ok": True, "pages": len(DOC_PAGES), "chunks": len(chunks)}
+    results, failed = await fetch_embedding_batch_results(async_openai, batch)
 
-@api.get("/qdrant/status")
-def qdrant_status():
-    if QDRANT_CLIENT is None:
-        raise HTTPException(status_code=500, detail="Qdrant client not initialized")
+    by_source: dict[str, List[dict]] = {}
+    for key, (text, vec) in results.items():
+        src, page, chunk_index = parse_chunk_key(key)
+        by_source.setdefault(src, []).append({"page": page, "chunk_index": chunk_index, "text": text, "vector": vec})
+
+    # completed_at を ingest 時刻として記録
+    ingested_at = datetime.fromtimestamp(batch.completed_at or batch.created_at, timezone.utc).isoformat()
+    n_chunks = 0
+    for src, chunks in by_source.items():
+        ids, payloads = build_points(src, chunks, ingested_at, batch_id=batch.id)
+        await upsert_points(qdrant, async_qdrant, ids, [c["vector"] for c in chunks], payloads)
+        # 失敗したチャンクがあると keep_ids から漏れて既存の点まで消えるので、全件成功時だけ古いチャンクを削除
+        if not failed:
+            await run_in_threadpool(delete_by_source, qdrant, settings.QDRANT_COLLECTION, src, keep_ids=ids)
+        n_chunks += len(ids)
+
+    return {
+        "ok": not failed,
+        "batch_id": batch.id,
+        "status": batch.status,
+        "request_counts": counts,
+        "chunks": n_chunks,
+        "failed": failed,
+    }
 
+@api.get("/qdrant/status")
+def qdrant_status(
+    qdrant: QdrantClient = Depends(get_qdrant),
+    qdrant_mode: str = Depends(get_qdrant_mode),
+    embed_dim: int = Depends(get_embed_dim),
+):
     collection = settings.QDRANT_COLLECTION
 
     try:
-        points_count = QDRANT_CLIENT.count(collection_name=collection, exact=True).count
+        points_count = qdrant.count(collection_name=collection, exact=True).count
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to read qdrant status: {e}")
 
-    sources: set[str] = set()
-    last_ingested_at: str | None = None
-
     try:
-        offset = None
-        while True:
-            points, offset = QDRANT_CLIENT.scroll(
-                collection_name=collection,
-                limit=256,
-                with_payload=True,
-                with_vectors=False,
-                offset=offset,
-            )
-
-            for p in points:
-                payload = p.payload or {}
-                src = payload.get("source")
-                if isinstance(src, str) and src:
-                    sources.add(src)
-
-                ts = payload.get("ingested_at")
-                if isinstance(ts, str) and ts:
-                    if last_ingested_at is None or ts > last_ingested_at:
-                        last_ingested_at = ts
-
-            if offset is None:
-                break
+        sources = list_sources(qdrant, collection)
+        last_ingested_at = latest_ingested_at(qdrant, collection)
     except Exception:
-        sources = set()
+        sources = []
         last_ingested_at = None
 
     return {
-        "mode": QDRANT_MODE,
+        "mode": qdrant_mode,
         "qdrant_path": str(settings.QDRANT_PATH) if settings.QDRANT_PATH else None,
         "collection": collection,
         "points_count": points_count,
         "embedding_model": settings.OPENAI_EMBEDDING_MODEL,
-        "embedding_dim": EMBED_DIM,
-        "sources": sorted(list(sources)),
+        "embedding_dim": embed_dim,
+        "sources": sorted(sources),
         "last_ingested_at": last_ingested_at,
     }
 
@@ -182,83 +405,239 @@ class QueryResponse(BaseModel):
     categories: List[str]
     evidence: List[Evidence]
 
-from services.category_service import classify_categories
+OUT_OF_SCOPE_ANSWER = "This question is outside the supported diabetes guideline topics, or no supporting evidence was retrieved."
 
-@api.post("/query", response_model=QueryResponse)
-def query(req: QueryRequest):
-    if QDRANT_CLIENT is None or OPENAI_CLIENT is None:
-        raise HTTPException(status_code=500, detail="Services not initialized")
+def to_evidence(hits: list[dict]) -> List[Evidence]:
+    # hits は search_similar が組み立てた内部データなので検証は省略（model_construct）
+    return [
+        Evidence.model_construct(
+            source=h.get("source"),
+            page=h.get("page") or 0,
+            text=h.get("text") or "",
+            score=h.get("score") or 0.0,
+        )
+        for h in hits
+    ]
+
+# ---- SSE（Accept: text/event-stream のクライアント向け）----
+# event: meta  -> {"categories": [...], "evidence": [...]}
+# event: delta -> {"text": "..."}（回答テキストの差分）
+# event: done  -> {"answer": "..."}（完成した回答）
+# event: error -> {"detail": "..."}
+def sse_frame(event: str, data: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+def wants_event_stream(request: Request) -> bool:
+    return "text/event-stream" in request.headers.get("accept", "")
+
+def evidence_dicts(hits: list[dict]) -> list[dict]:
+    return [e.model_dump() for e in to_evidence(hits)]
+
+async def sse_out_of_scope(hits: list[dict], debug_return_evidence: bool) -> AsyncIterator[bytes]:
+    yield sse_frame("meta", {"categories": [], "evidence": evidence_dicts(hits) if debug_return_evidence else []})
+    yield sse_frame("done", {"answer": OUT_OF_SCOPE_ANSWER})
+
+async def sse_query(
+    async_openai: AsyncOpenAI,
+    question: str,
+    hits: list[dict],
+    debug_return_evidence: bool,
+    classify_cache: Cache | None = None,
+) -> AsyncIterator[bytes]:
+    # 回答ストリームはカテゴリ推定と並行して開始し、meta を送るまで差分をキューに溜める
+    deltas: asyncio.Queue[str | None] = asyncio.Queue()
+
+    async def pump() -> None:
+        try:
+            async for delta in stream_answer(async_openai, settings.OPENAI_CHAT_MODEL, question, hits):
+                deltas.put_nowait(delta)
+        finally:
+            deltas.put_nowait(None)
+
+    cats_task = asyncio.create_task(
+        classify_categories(async_openai, settings.OPENAI_CHAT_MODEL, question, hits, cache=classify_cache)
+    )
+    pump_task = asyncio.create_task(pump())
+    try:
+        categories = await cats_task
+        if not categories:
+            async for frame in sse_out_of_scope(hits, debug_return_evidence):
+                yield frame
+            return
+
+        yield sse_frame("meta", {"categories": categories, "evidence": evidence_dicts(hits)})
+        parts: list[str] = []
+        while (delta := await deltas.get()) is not None:
+            parts.append(delta)
+            yield sse_frame("delta", {"text": delta})
+        await pump_task  # ストリームが例外で終わっていればここで送出
+        yield sse_frame("done", {"answer": "".join(parts).strip()})
+    except Exception as e:
+        yield sse_frame("error", {"detail": str(e)})
+    finally:
+        cats_task.cancel()
+        pump_task.cancel()
+
+from services.category_service import SCORE_THRESHOLD, classify_categories, classify_categories_batch
 
+async def retrieve_hits(openai_client: OpenAI, qdrant: QdrantClient, question: str, top_k: int) -> list[dict]:
     # 1) 質問をベクトル化
-    qvec = embed_text(
-        OPENAI_CLIENT,
+    qvec = await run_in_threadpool(
+        embed_query,
+        openai_client,
         settings.OPENAI_EMBEDDING_MODEL,
-        req.question,
+        question,
     )
 
     # 2) Qdrantで検索してevidenceを作る
-    hits = search_similar(
-        QDRANT_CLIENT,
+    return await run_in_threadpool(
+        search_similar,
+        qdrant,
         settings.QDRANT_COLLECTION,
         query_vector=qvec,
-        top_k=req.top_k,
+        top_k=top_k,
     )
 
-    evidence = [
-        Evidence(source=h.get("source"), page=h.get("page") or 0, text=h.get("text") or "", score=h.get("score") or 0.0)
-        for h in hits
-    ]
+def is_answerable(hits: list[dict]) -> bool:
+    # 根拠スコアが低い質問は LLM を呼ばない（対象外かどうかの判定は分類器に任せる）
+    top_score = float(hits[0].get("score") or 0.0) if hits else 0.0
+    return top_score >= SCORE_THRESHOLD
 
-    # 3) ここにカテゴリ推定を入れる
-    categories = classify_categories(
-        OPENAI_CLIENT,
-        settings.OPENAI_CHAT_MODEL,
-        req.question,
-        [e.model_dump() for e in evidence],
+def out_of_scope_response(hits: list[dict], debug_return_evidence: bool) -> QueryResponse:
+    return QueryResponse(
+        answer=OUT_OF_SCOPE_ANSWER,
+        categories=[],
+        evidence=(to_evidence(hits) if debug_return_evidence else []),
     )
 
-    # 4) カテゴリが0件なら早期リターン  
-    if not categories:
-        return QueryResponse(
-            answer="This question is outside the supported diabetes guideline topics, or no supporting evidence was retrieved.",
-            categories=[],
-            evidence=(evidence if req.debug_return_evidence else []),
+@api.post("/query", response_model=QueryResponse)
+async def query(
+    req: QueryRequest,
+    request: Request,
+    qdrant: QdrantClient = Depends(get_qdrant),
+    openai_client: OpenAI = Depends(get_openai),
+    async_openai: AsyncOpenAI = Depends(get_async_openai),
+    classify_cache: Cache | None = Depends(get_classify_cache),
+):
+    # 1-2) 埋め込み → 検索
+    hits = await retrieve_hits(openai_client, qdrant, req.question, req.top_k)
+
+    # 3) 根拠スコアが低い質問は LLM を呼ばずに早期リターン
+    if not is_answerable(hits):
+        if wants_event_stream(request):
+            return StreamingResponse(sse_out_of_scope(hits, req.debug_return_evidence), media_type="text/event-stream")
+        return out_of_scope_response(hits, req.debug_return_evidence)
+
+    # ストリーミング要求なら SSE で返す（それ以外は従来どおり JSON）
+    if wants_event_stream(request):
+        return StreamingResponse(
+            sse_query(async_openai, req.question, hits, req.debug_return_evidence, classify_cache),
+            media_type="text/event-stream",
         )
 
-    # 5) 回答生成（既存の generate_answer を呼ぶ）
-    answer = generate_answer(
-        OPENAI_CLIENT,
-        settings.OPENAI_CHAT_MODEL,
-        req.question,
-        [e.model_dump() for e in evidence],
+    # 4) カテゴリ推定と回答生成を並行実行（レイテンシ = max(cats, answer)）
+    cats_task = asyncio.create_task(
+        classify_categories(async_openai, settings.OPENAI_CHAT_MODEL, req.question, hits, cache=classify_cache)
+    )
+    ans_task = asyncio.create_task(
+        generate_answer(async_openai, settings.OPENAI_CHAT_MODEL, req.question, hits)
     )
 
-    return QueryResponse(answer=answer, categories=categories, evidence=evidence)
+    try:
+        categories = await cats_task
+
+        # 5) カテゴリが0件なら早期リターン（回答生成はキャンセル）
+        if not categories:
+            return out_of_scope_response(hits, req.debug_return_evidence)
+
+        # 6) 回答生成の結果を待つ
+        answer = await ans_task
+    finally:
+        ans_task.cancel()  # 完了済みなら何もしない
+
+    return QueryResponse(answer=answer, categories=categories, evidence=to_evidence(hits))
+
+# 1リクエストの質問数の上限（埋め込み / 回答生成が質問数ぶん並行に走り、分類プロンプトも質問数に比例する）
+MAX_BATCH_QUERIES = 32
+
+class QueryBatchRequest(BaseModel):
+    queries: List[QueryRequest] = Field(max_length=MAX_BATCH_QUERIES)
+
+class QueryBatchResponse(BaseModel):
+    results: List[QueryResponse]
+
+# 複数の質問をまとめて処理（eval 向け：カテゴリ分類は1回の Responses 呼び出しに集約）
+@api.post("/query/batch", response_model=QueryBatchResponse)
+async def query_batch(
+    req: QueryBatchRequest,
+    qdrant: QdrantClient = Depends(get_qdrant),
+    openai_client: OpenAI = Depends(get_openai),
+    async_openai: AsyncOpenAI = Depends(get_async_openai),
+    classify_cache: Cache | None = Depends(get_classify_cache),
+):
+    queries = req.queries
+
+    # 1-2) 各質問の埋め込み → 検索（並行）
+    all_hits = await asyncio.gather(*(retrieve_hits(openai_client, qdrant, q.question, q.top_k) for q in queries))
+
+    # 3) 早期リターン対象以外について、回答生成を先に開始しつつカテゴリをまとめて推定
+    targets = [i for i, hits in enumerate(all_hits) if is_answerable(hits)]
+    ans_tasks = {
+        i: asyncio.create_task(generate_answer(async_openai, settings.OPENAI_CHAT_MODEL, queries[i].question, all_hits[i]))
+        for i in targets
+    }
+    try:
+        batch_cats = await classify_categories_batch(
+            async_openai,
+            settings.OPENAI_CHAT_MODEL,
+            [{"question": queries[i].question, "evidence": all_hits[i]} for i in targets],
+            cache=classify_cache,
+        )
+        categories = dict(zip(targets, batch_cats))
+
+        # 4) カテゴリ0件のものは回答生成をキャンセルし、残りの回答を待つ
+        for i, cats in categories.items():
+            if not cats:
+                ans_tasks.pop(i).cancel()
+        answers = dict(zip(ans_tasks, await asyncio.gather(*ans_tasks.values())))
+    finally:
+        for t in ans_tasks.values():
+            t.cancel()  # 完了済みなら何もしない
+
+    results = [
+        QueryResponse(answer=answers[i], categories=categories[i], evidence=to_evidence(hits))
+        if i in answers
+        else out_of_scope_response(hits, q.debug_return_evidence)
+        for i, (q, hits) in enumerate(zip(queries, all_hits))
+    ]
+    return QueryBatchResponse(results=results)
 
 
 @api.get("/debug/pdf")
-def debug_pdf(page: int = 1, chars: int = 300):
-    if not DOC_PAGES:
+def debug_pdf(request: Request, page: int = 1, chars: int = 300):
+    doc_pages = request.app.state.doc_pages
+    if not doc_pages:
         raise HTTPException(status_code=400, detail="No document ingested yet. Call POST /ingest first.")
-    if page < 1 or page > len(DOC_PAGES):
-        raise HTTPException(status_code=400, detail=f"page must be between 1 and {len(DOC_PAGES)}")
+    if page < 1 or page > len(doc_pages):
+        raise HTTPException(status_code=400, detail=f"page must be between 1 and {len(doc_pages)}")
 
-    text = DOC_PAGES[page - 1]["text"] or ""
-    return {"pages": len(DOC_PAGES), "page": page, "preview": text[:chars]}
+    text = doc_pages[page - 1]["text"] or ""
+    return {"pages": len(doc_pages), "page": page, "preview": text[:chars]}
 
 @api.get("/debug/qdrant")
-def debug_qdrant():
-    if QDRANT_CLIENT is None:
-        raise HTTPException(status_code=500, detail="Qdrant client not initialized")
-
-    cols = QDRANT_CLIENT.get_collections()
+def debug_qdrant(
+    qdrant: QdrantClient = Depends(get_qdrant),
+    qdrant_mode: str = Depends(get_qdrant_mode),
+    embed_dim: int = Depends(get_embed_dim),
+):
+    cols = qdrant.get_collections()
     names = [c.name for c in cols.collections]
 
     return {
-        "mode": QDRANT_MODE,
+        "mode": qdrant_mode,
         "collection": settings.QDRANT_COLLECTION,
         "embedding_model": settings.OPENAI_EMBEDDING_MODEL,
-        "embedding_dim": EMBED_DIM,
+        "embedding_dim": embed_dim,
         "collections": names,
     }
 
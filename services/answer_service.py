@@ -1,4 +1,6 @@
-from openai import OpenAI
+from typing import AsyncIterator
+
+from openai import AsyncOpenAI
 
 SYSTEM_PROMPT = """You are a clinical guideline assistant.
 Answer ONLY using the provided evidence. If evidence is insufficient, say so.
@@ -13,14 +15,9 @@ def build_context(evidence: list[dict]) -> str:
         lines.append(f"[p{page}] {text}")
     return "\n".join(lines)
 
-def generate_answer(
-    client: OpenAI,
-    model: str,
-    question: str,
-    evidence: list[dict],
-) -> str:
+def build_user_prompt(question: str, evidence: list[dict]) -> str:
     context = build_context(evidence)
-    user_prompt = f"""Question:
+    return f"""Question:
 {question}
 
 Evidence:
@@ -28,10 +25,33 @@ Evidence:
 
 Write an answer based on the evidence above."""
 
-    resp = client.responses.create(
+async def generate_answer(
+    client: AsyncOpenAI,
+    model: str,
+    question: str,
+    evidence: list[dict],
+) -> str:
+    resp = await client.responses.create(
         model=model,
         instructions=SYSTEM_PROMPT,
-        input=user_prompt,
+        input=build_user_prompt(question, evidence),
     )
 
-    return (resp.output_text or "").strip()
\ No newline at end of file
+    return (resp.output_text or "").strip()
+
+async def stream_answer(
+    client: AsyncOpenAI,
+    model: str,
+    question: str,
+    evidence: list[dict],
+) -> AsyncIterator[str]:
+    """Same as generate_answer, but yields output text deltas as they arrive."""
+    stream = await client.responses.create(
+        model=model,
+        instructions=SYSTEM_PROMPT,
+        input=build_user_prompt(question, evidence),
+        stream=True,
+    )
+    async for event in stream:
+        if event.type == "response.output_text.delta":
+            yield event.delta
@@ -1,8 +1,12 @@
 from __future__ import annotations
 
-import json
-from typing import Any
-from openai import OpenAI
+import asyncio
+import hashlib
+from typing import Literal
+import orjson
+from diskcache import Cache
+from openai import AsyncOpenAI, ContentFilterFinishReasonError, LengthFinishReasonError
+from pydantic import BaseModel, Field, ValidationError
 
 CATEGORIES = [
     "Lifestyle management recommendations",
@@ -11,19 +15,115 @@ CATEGORIES = [
     "Referral criteria",
 ]
 
-def _extract_text(resp: Any) -> str:
-    t = getattr(resp, "output_text", None)
-    if isinstance(t, str) and t.strip():
-        return t
-    return str(resp)
+# 取得スコアがこれ未満なら根拠なしとみなす
+SCORE_THRESHOLD = 0.2
+
+# --- Structured Outputs (responses.parse が strict json_schema に変換し、応答を検証済みモデルで返す) ---
+Category = Literal[tuple(CATEGORIES)]
+
+class CategoryClassification(BaseModel):
+    categories: list[Category] = Field(max_length=4)
+
+# 複数ケースを1リクエストで分類する用（id で入力ケースと対応づける）
+class CaseClassification(BaseModel):
+    id: str
+    categories: list[Category] = Field(max_length=4)
+
+class BatchClassification(BaseModel):
+    results: list[CaseClassification]
+
+# 単発 / バッチで同じ system prompt（先頭が一致するので OpenAI の prompt caching が効く）
+_SYSTEM_PROMPT = (
+    "You are a strict classifier for clinician queries about diabetes guideline content.\n"
+    "Choose ALL applicable categories from the allowed list, but ONLY if the evidence supports them.\n"
+    "If the question is out-of-scope OR evidence is insufficient/irrelevant, return an EMPTY list.\n\n"
+    "Allowed categories (exact strings):\n"
+    f"{CATEGORIES}\n\n"
+    "Category definitions & boundaries:\n"
+    "- Lifestyle management recommendations: diet, physical activity, weight loss, smoking/alcohol avoidance, patient education/self-management, foot hygiene/footwear advice.\n"
+    "- Medication protocol guidance: medicines (insulin/oral agents/etc), medication adherence, self-monitoring tools/strips/meters, medication-related monitoring practices.\n"
+    "- Complication screening schedules: screening/monitoring/exams for complications (eye exam, urine protein/kidney tests, foot/neuropathy assessment) and monitoring schedules (e.g., HbA1c frequency) when discussed as a schedule/assessment.\n"
+    "- Referral criteria: referral/back-referral, escalation to specialist assessment or secondary/tertiary care criteria.\n\n"
+    "Tie-break rules (important):\n"
+    "- If it is primarily about screening/exam frequency or routine assessment -> Complication screening schedules.\n"
+    "- If it is primarily about drugs, treatment protocols, or self-monitoring devices/strips -> Medication protocol guidance.\n"
+    "- If it mentions referral/back-referral or specialist escalation -> Referral criteria.\n"
+    "- If it is about lifestyle counselling/education -> Lifestyle management recommendations.\n\n"
+    "Return STRICT JSON only according to the schema."
+)
+_PROMPT_CACHE_KEY = "category_classification"
+
+def _cache_key(model: str, variant: str, question: str, top_evs: list[dict]) -> str:
+    # 同じ質問 + 同じ根拠（source, page と分類に渡す本文）なら分類結果も同じとみなす
+    # 本文もキーに含めるので、PDF を更新して再 ingest すれば古い分類は使われない
+    # variant: 単発 / バッチはプロンプトが違うので結果を混ぜない
+    raw = orjson.dumps(
+        {"m": model, "v": variant, "q": question, "ev": [(e["source"], e["page"], e["text"]) for e in top_evs]},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(raw).hexdigest()
+
+# diskcache は SQLite へのブロッキング I/O なので、イベントループの外（スレッド）で読み書きする
+def _cache_get_many(cache: Cache, keys: list[str]) -> list:
+    return [cache.get(key) for key in keys]
+
+def _cache_set_many(cache: Cache, items: list[tuple[str, list[str]]]) -> None:
+    for key, value in items:
+        cache.set(key, value)
+
+def _top_evidence(evidence: list[dict], score_threshold: float) -> list[dict]:
+    """Top 5 evidence (text truncated to control cost), or [] if there is no usable evidence."""
+    if not evidence:
+        return []
+
+    # Ensure highest-score first (defensive)
+    evidence_sorted = sorted(evidence, key=lambda x: float(x.get("score") or 0.0), reverse=True)
+
+    top_score = float(evidence_sorted[0].get("score") or 0.0)
+    if top_score < score_threshold:
+        return []
 
-def classify_categories(
-    client: OpenAI,
+    return [
+        {
+            "source": e.get("source"),
+            "page": e.get("page"),
+            "score": e.get("score"),
+            "text": (e.get("text") or "")[:900],
+        }
+        for e in evidence_sorted[:5]
+    ]
+
+def _filter_categories(cats: list[str]) -> list[str]:
+    # 重複除去（出現順を保持）。値は Literal 検証済みで CATEGORIES の str そのものが返る
+    return list(dict.fromkeys(cats))
+
+async def _parse(client: AsyncOpenAI, model: str, user_payload: dict, text_format: type[BaseModel]) -> BaseModel | None:
+    """Return the parsed text_format instance, or None if the output was refused, missing, truncated or invalid."""
+    try:
+        resp = await client.responses.parse(
+            model=model,
+            temperature=0,
+            input=[
+                {"role": "system", "content": [{"type": "input_text", "text": _SYSTEM_PROMPT}]},
+                # orjson: UTF-8 のまま1回でシリアライズ（input_text は文字列なので dict のままは渡せない）
+                {"role": "user", "content": [{"type": "input_text", "text": orjson.dumps(user_payload).decode()}]},
+            ],
+            prompt_cache_key=_PROMPT_CACHE_KEY,
+            text_format=text_format,
+        )
+    except (ValidationError, LengthFinishReasonError, ContentFilterFinishReasonError):
+        # 解析できない出力（途中で切れた / schema 不一致）は従来どおり「分類なし」扱い
+        return None
+    return resp.output_parsed
+
+async def classify_categories(
+    client: AsyncOpenAI,
     model: str,
     question: str,
     evidence: list[dict],
     *,
-    score_threshold: float = 0.2,
+    score_threshold: float = SCORE_THRESHOLD,
+    cache: Cache | None = None,
 ) -> list[str]:
     """
     Return 0..4 categories aligned with the requirements.
@@ -34,107 +134,87 @@ def classify_categories(
     - If out-of-scope OR insufficient evidence -> [].
     """
 
-    if not evidence:
+    top_evs = _top_evidence(evidence, score_threshold)
+    if not top_evs:
         return []
 
-    # Ensure highest-score first (defensive)
-    evidence_sorted = sorted(evidence, key=lambda x: float(x.get("score") or 0.0), reverse=True)
-
-    top_score = float(evidence_sorted[0].get("score") or 0.0)
-    if top_score < score_threshold:
-        return []
-
-    # Take top N evidence and truncate text to control cost
-    top_evs = []
-    for e in evidence_sorted[:5]:
-        top_evs.append(
-            {
-                "source": e.get("source"),
-                "page": e.get("page"),
-                "score": e.get("score"),
-                "text": (e.get("text") or "")[:900],
-            }
-        )
-
-    # --- Structured Outputs schema (json_schema) ---
-    schema = {
-        "type": "object",
-        "additionalProperties": False,
-        "properties": {
-            "categories": {
-                "type": "array",
-                "maxItems": 4,
-                "items": {"type": "string", "enum": CATEGORIES},
-            }
-        },
-        "required": ["categories"],
-    }
-
-    system = (
-        "You are a strict classifier for clinician queries about diabetes guideline content.\n"
-        "Choose ALL applicable categories from the allowed list, but ONLY if the evidence supports them.\n"
-        "If the question is out-of-scope OR evidence is insufficient/irrelevant, return an EMPTY list.\n\n"
-        "Allowed categories (exact strings):\n"
-        f"{CATEGORIES}\n\n"
-        "Category definitions & boundaries:\n"
-        "- Lifestyle management recommendations: diet, physical activity, weight loss, smoking/alcohol avoidance, patient education/self-management, foot hygiene/footwear advice.\n"
-        "- Medication protocol guidance: medicines (insulin/oral agents/etc), medication adherence, self-monitoring tools/strips/meters, medication-related monitoring practices.\n"
-        "- Complication screening schedules: screening/monitoring/exams for complications (eye exam, urine protein/kidney tests, foot/neuropathy assessment) and monitoring schedules (e.g., HbA1c frequency) when discussed as a schedule/assessment.\n"
-        "- Referral criteria: referral/back-referral, escalation to specialist assessment or secondary/tertiary care criteria.\n\n"
-        "Tie-break rules (important):\n"
-        "- If it is primarily about screening/exam frequency or routine assessment -> Complication screening schedules.\n"
-        "- If it is primarily about drugs, treatment protocols, or self-monitoring devices/strips -> Medication protocol guidance.\n"
-        "- If it mentions referral/back-referral or specialist escalation -> Referral criteria.\n"
-        "- If it is about lifestyle counselling/education -> Lifestyle management recommendations.\n\n"
-        "Return STRICT JSON only according to the schema."
-    )
+    key = _cache_key(model, "single", question, top_evs) if cache is not None else None
+    if key is not None:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return list(cached)
 
     user_payload = {
         "question": question,
         "evidence": top_evs,
         "note": "Select categories supported by evidence. If unsupported, return [].",
     }
+    parsed = await _parse(client, model, user_payload, CategoryClassification)
+    if parsed is None:
+        return []
+    out = _filter_categories(parsed.categories)
 
-    try:
-        resp = client.responses.create(
-            model=model,
-            temperature=0,
-            input=[
-                {"role": "system", "content": [{"type": "input_text", "text": system}]},
-                {"role": "user", "content": [{"type": "input_text", "text": json.dumps(user_payload, ensure_ascii=False)}]},
-            ],
-            text={
-                "format": {
-                    "type": "json_schema",
-                    "name": "category_classification",
-                    "strict": True,
-                    "schema": schema,
-                }
-            },
-        )
-    except Exception:
-        # If the SDK/environment doesn't accept text.format, fall back to plain response parsing
-        resp = client.responses.create(
-            model=model,
-            input=[
-                {"role": "system", "content": [{"type": "input_text", "text": system}]},
-                {"role": "user", "content": [{"type": "input_text", "text": json.dumps(user_payload, ensure_ascii=False)}]},
-            ],
-        )
+    # 分類できた結果だけ保存（拒否 / 出力なしの [] はキャッシュしない）
+    if key is not None:
+        await asyncio.to_thread(cache.set, key, out)
+    return out
 
-    raw = _extract_text(resp).strip()
+async def classify_categories_batch(
+    client: AsyncOpenAI,
+    model: str,
+    items: list[dict],
+    *,
+    score_threshold: float = SCORE_THRESHOLD,
+    cache: Cache | None = None,
+) -> list[list[str]]:
+    """
+    items: [{"question": "...", "evidence": [...]}, ...]
+    return: categories per item (same order). Items that need the LLM share ONE Responses call.
+    """
+    results: list[list[str]] = [[] for _ in items]
+    cases: list[dict] = []
+    pending: dict[str, tuple[int, str | None]] = {}
+
+    # 根拠のある item だけ (i, item, top_evs) にする
+    gated = [
+        (i, item, top_evs)
+        for i, item in enumerate(items)
+        if (top_evs := _top_evidence(item.get("evidence") or [], score_threshold))
+    ]
+    keys: list[str | None] = [None] * len(gated)
+    cached_all: list = [None] * len(gated)
+    if cache is not None:
+        keys = [_cache_key(model, "batch", item["question"], top_evs) for _, item, top_evs in gated]
+        cached_all = await asyncio.to_thread(_cache_get_many, cache, keys)
+
+    for (i, item, top_evs), key, cached in zip(gated, keys, cached_all):
+        if cached is not None:
+            results[i] = list(cached)
+            continue
+        pending[str(i)] = (i, key)
+        cases.append({"id": str(i), "question": item["question"], "evidence": top_evs})
+
+    if not cases:
+        return results
 
-    try:
-        data = json.loads(raw)
-        cats = data.get("categories", [])
-        if not isinstance(cats, list):
-            return []
-
-        allowed = set(CATEGORIES)
-        out: list[str] = []
-        for c in cats:
-            if isinstance(c, str) and c in allowed and c not in out:
-                out.append(c)
-        return out
-    except Exception:
-        return []
\ No newline at end of file
+    user_payload = {
+        "cases": cases,
+        "note": "Classify EACH case independently and return one result per case id. "
+        "Select categories supported by that case's evidence. If unsupported, return [].",
+    }
+    parsed = await _parse(client, model, user_payload, BatchClassification)
+    if parsed is None:
+        return results
+
+    to_cache: list[tuple[str, list[str]]] = []
+    for row in parsed.results:
+        entry = pending.get(row.id)
+        if entry is None:
+            continue
+        i, key = entry
+        results[i] = _filter_categories(row.categories)
+        if key is not None:
+            to_cache.append((key, results[i]))
+    if to_cache:
+        await asyncio.to_thread(_cache_set_many, cache, to_cache)
+    return results
@@ -0,0 +1,51 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# SQLite の bind 変数上限 (古いビルドは 999) を超えないよう IN 句を分割
+_LOOKUP_CHUNK = 900
+
+# 接続はプロセスで1本を asyncio.to_thread から共有する。並行 ingest で別スレッドの
+# `with conn:` が他方の文を commit / rollback しないよう、読み書きはこのロックで直列化
+_LOCK = threading.Lock()
+
+def open_cache(path: str) -> sqlite3.Connection:
+    """埋め込みキャッシュ (sha256 → float32 vector) を開く。無ければ作成"""
+    if path != ":memory:":
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+    # ingest はスレッドプールから読む/書くので check_same_thread=False
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL) WITHOUT ROWID"
+    )
+    conn.commit()
+    return conn
+
+def cache_key(model: str, text: str) -> bytes:
+    # モデルが変われば別のベクトルなので model もキーに含める
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+def get_many(conn: sqlite3.Connection, keys: list[bytes]) -> dict[bytes, np.ndarray]:
+    hits: dict[bytes, np.ndarray] = {}
+    with _LOCK:
+        for start in range(0, len(keys), _LOOKUP_CHUNK):
+            part = keys[start:start + _LOOKUP_CHUNK]
+            rows = conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({','.join('?' * len(part))})",
+                part,
+            )
+            for key, blob in rows:
+                hits[key] = np.frombuffer(blob, dtype=np.float32)
+    return hits
+
+def put_many(conn: sqlite3.Connection, items: list[tuple[bytes, np.ndarray]]) -> None:
+    with _LOCK, conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)",
+            ((key, np.asarray(vec, dtype=np.float32).tobytes()) for key, vec in items),
+        )
@@ -1,26 +1,243 @@
-from openai import OpenAI
+import asyncio
+import base64
+import functools
+import itertools
+import json
+import random
+import sqlite3
 
-def embed_text(client: OpenAI, model: str, text: str) -> list[float]:
+import numpy as np
+from openai import APIStatusError, AsyncOpenAI, OpenAI
+from openai.types import Batch
+
+from services import embed_cache
+
+# /v1/embeddings の1リクエスト上限 (入力数 2048 / 合計 300k tokens) に余裕を持たせた上限
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 250_000
+
+def _estimate_tokens(text: str) -> int:
+    # 英文でおよそ 4 chars/token。tokenizer を通さない概算
+    return len(text) // 4 + 1
+
+def _decode_embeddings(resp) -> np.ndarray:
+    # encoding_format="base64": little-endian float32 bytes, no JSON float parsing
+    data = sorted(resp.data, key=lambda d: d.index)
+    return np.stack([np.frombuffer(base64.b64decode(d.embedding), dtype=np.float32) for d in data])
+
+def embed_text(client: OpenAI, model: str, text: str) -> np.ndarray:
     if not text.strip():
         raise ValueError("Embedding input must be non-empty")
 
+    # embed_texts と同じリクエスト形 (list 入力 + base64) / 同じデコード経路
     resp = client.embeddings.create(
         model=model,
-        input=text,
+        input=[text],
+        encoding_format="base64",
     )
-    return resp.data[0].embedding
+    return _decode_embeddings(resp)[0]
+
+@functools.lru_cache(maxsize=4096)
+def _embed_query_cached(client: OpenAI, model: str, normalized: str) -> np.ndarray:
+    # float32 のまま保持（3072 次元で約 12KB/件。Python float の tuple だと約 100KB/件）
+    vec = embed_text(client, model, normalized)
+    vec.setflags(write=False)  # キャッシュ共有の配列なので呼び出し側で書き換えさせない
+    return vec
+
+def embed_query(client: OpenAI, model: str, question: str) -> np.ndarray:
+    """Embed a search query; repeated questions (modulo case/whitespace) skip the OpenAI round-trip."""
+    normalized = " ".join(question.split()).lower()
+    if not normalized:
+        raise ValueError("Embedding input must be non-empty")
+    return _embed_query_cached(client, model, normalized)
 
 def detect_embedding_dim(client: OpenAI, model: str) -> int:
     vec = embed_text(client, model, "dimension probe")
     return len(vec)
 
-def embed_texts(client: OpenAI, model: str, texts: list[str]) -> list[list[float]]:
+def _pack_batches(texts: list[str], batch_size: int, max_tokens: int) -> list[list[str]]:
+    """Greedy-pack texts so each request stays within both the item and (estimated) token budgets."""
+    batch_size = min(batch_size, MAX_INPUTS_PER_REQUEST)
+    max_tokens = min(max_tokens, MAX_TOKENS_PER_REQUEST)
+    batches: list[list[str]] = []
+    cur: list[str] = []
+    cur_tokens = 0
+    for t in texts:
+        n_tokens = _estimate_tokens(t)
+        if cur and (len(cur) >= batch_size or cur_tokens + n_tokens > max_tokens):
+            batches.append(cur)
+            cur, cur_tokens = [], 0
+        cur.append(t)
+        cur_tokens += n_tokens
+    if cur:
+        batches.append(cur)
+    return batches
+
+async def _hedged(call, hedge_delay: float | None):
+    """Run call(); if it has not finished after hedge_delay, race a duplicate and keep the first success (None: no hedge)."""
+    pending = {asyncio.create_task(call())}
+    done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+    if not done:
+        pending.add(asyncio.create_task(call()))
+
+    error: BaseException | None = None
+    try:
+        while True:
+            for t in done:
+                if t.exception() is None:
+                    return t.result()
+                error = t.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for t in pending:
+            t.cancel()
+
+async def _embed_batch(
+    client: AsyncOpenAI,
+    model: str,
+    batch: list[str],
+    *,
+    hedge_delay: float | None,
+    max_retries: int,
+) -> np.ndarray:
+    # 再試行はこのループだけで行う（SDK 側の max_retries と重なると 429 時に送信回数が掛け算で増える）
+    client = client.with_options(max_retries=0)
+    attempt = 0
+    while True:
+        try:
+            resp = await _hedged(
+                lambda: client.embeddings.create(model=model, input=batch, encoding_format="base64"),
+                hedge_delay,
+            )
+            return _decode_embeddings(resp)
+        except APIStatusError as e:
+            retryable = e.status_code == 429 or e.status_code >= 500
+            if not retryable or attempt >= max_retries:
+                raise
+        # exponential backoff with jitter
+        await asyncio.sleep(0.5 * 2**attempt + random.uniform(0, 0.25))
+        attempt += 1
+
+async def embed_texts(
+    client: AsyncOpenAI,
+    model: str,
+    texts: list[str],
+    *,
+    cache: sqlite3.Connection | None = None,
+    batch_size: int = 128,
+    max_tokens_per_request: int = 5000,
+    max_concurrent_requests: int = 16,
+    hedge_delay: float | None = None,
+    max_retries: int = 3,
+) -> np.ndarray:
+    """
+    return: float32 array of shape (len(cleaned texts), dim)
+    cache を渡すと、同じ (model, text) の埋め込みはキャッシュから返し、ミス分だけ API に投げる
+    hedge_delay は既定で無効（128件 / 5000 tokens のシャードは普通に数秒かかるので、短い固定値だと
+    ほぼ全シャードが二重に送られ、token 消費と 429 が倍になる。使うなら通常のレイテンシより十分長く）
+    """
     cleaned = [t.strip() for t in texts if t and t.strip()]
     if not cleaned:
-        return []
+        return np.empty((0, 0), dtype=np.float32)
 
-    resp = client.embeddings.create(
-        model=model,
-        input=cleaned,
+    # 結果は (N, dim) の1枚の配列に書き込む（キャッシュヒット → API 結果の順、concatenate のコピーなし）
+    out: np.ndarray | None = None
+    keys: list[bytes] = []
+    hits: dict[bytes, np.ndarray] = {}
+    if cache is not None:
+        keys = [embed_cache.cache_key(model, t) for t in cleaned]
+        hits = await asyncio.to_thread(embed_cache.get_many, cache, keys)
+    if hits:
+        out = np.empty((len(cleaned), len(next(iter(hits.values())))), dtype=np.float32)
+        for i, key in enumerate(keys):
+            vec = hits.get(key)
+            if vec is not None:
+                out[i] = vec
+    todo = [i for i, key in enumerate(keys) if key not in hits] if keys else list(range(len(cleaned)))
+    if not todo:
+        return out
+
+    # 小さめのシャードを並列に投げる (1本の巨大リクエストより hedge / retry のコストが小さい)
+    batches = _pack_batches([cleaned[i] for i in todo], batch_size, max_tokens_per_request)
+    sem = asyncio.Semaphore(max_concurrent_requests)
+
+    async def _run(batch: list[str], offset: int) -> None:
+        nonlocal out
+        async with sem:
+            vecs = await _embed_batch(client, model, batch, hedge_delay=hedge_delay, max_retries=max_retries)
+        if out is None:
+            out = np.empty((len(cleaned), vecs.shape[1]), dtype=np.float32)
+        out[todo[offset:offset + len(vecs)]] = vecs
+
+    offsets = itertools.accumulate((len(b) for b in batches[:-1]), initial=0)
+    await asyncio.gather(*(_run(b, offset) for b, offset in zip(batches, offsets)))
+
+    if cache is not None:
+        await asyncio.to_thread(embed_cache.put_many, cache, [(keys[i], out[i]) for i in todo])
+    return out
+
+def build_embedding_batch_jsonl(model: str, items: list[tuple[str, str]]) -> bytes:
+    """items: [(custom_id, text), ...] -> Batch API input file (one /v1/embeddings request per line)"""
+    lines = [
+        json.dumps(
+            {
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": "/v1/embeddings",
+                "body": {"model": model, "input": text},
+            },
+            ensure_ascii=False,
+        )
+        for custom_id, text in items
+    ]
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+async def submit_embedding_batch(
+    client: AsyncOpenAI,
+    model: str,
+    items: list[tuple[str, str]],
+    metadata: dict[str, str] | None = None,
+) -> Batch:
+    data = build_embedding_batch_jsonl(model, items)
+    input_file = await client.files.create(file=("embeddings.jsonl", data), purpose="batch")
+    return await client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/embeddings",
+        completion_window="24h",
+        metadata=metadata,
     )
-    return [d.embedding for d in resp.data]
\ No newline at end of file
+
+async def fetch_embedding_batch_results(
+    client: AsyncOpenAI, batch: Batch
+) -> tuple[dict[str, tuple[str, list[float]]], list[str]]:
+    """
+    Download a completed embedding batch.
+    return: ({custom_id: (text, vector)}, [custom_id of failed / missing requests])
+    """
+    # Texts are read back from the input file, so no state is kept between submit and fetch
+    input_content = await client.files.content(batch.input_file_id)
+    texts: dict[str, str] = {}
+    for line in input_content.text.splitlines():
+        if line.strip():
+            req = json.loads(line)
+            texts[req["custom_id"]] = req["body"]["input"]
+
+    results: dict[str, tuple[str, list[float]]] = {}
+    # 全リクエストが失敗した batch は output_file_id が None（error_file_id のみ）
+    if batch.output_file_id is not None:
+        output_content = await client.files.content(batch.output_file_id)
+        for line in output_content.text.splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            resp = row.get("response") or {}
+            if row.get("error") or resp.get("status_code") != 200:
+                continue
+            custom_id = row["custom_id"]
+            results[custom_id] = (texts[custom_id], resp["body"]["data"][0]["embedding"])
+
+    # 入力にあって結果に無いもの = 失敗（non-200 / error / 出力なし）
+    failed = [custom_id for custom_id in texts if custom_id not in results]
+    return results, failed
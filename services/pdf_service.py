@@ -1,27 +1,89 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import List
-from pypdf import PdfReader
 
-def extract_pages(pdf_path: str) -> List[dict]:
-    reader = PdfReader(pdf_path)
-    pages: List[dict] = []
-    for i, page in enumerate(reader.pages, start=1):
-        text = page.extract_text() or ""
-        pages.append({"page": i, "text": text})
-    return pages
+import pypdfium2 as pdfium
+
+# これ未満のページ数ならプロセス起動コストの方が大きいので直列で抽出
+PARALLEL_MIN_PAGES = 32
+
+# PDFium はスレッドセーフではない。同一プロセス内の PDFium 呼び出し（open / len / 直列抽出 / close）は
+# すべてこのロックの下で行う（ingest は run_in_threadpool から並行に呼ばれる。プールのワーカーは1タスクずつなので不要）
+_PDFIUM_LOCK = threading.Lock()
+
+# PDFium の改行は \r\n、行末ハイフンは U+FFFE で返る → pypdf 時代と同じ形に揃える
+_TEXT_FIXUPS = str.maketrans({"\r": None, "\ufffe": "-"})
+
+def _page_text(pdf: pdfium.PdfDocument, index: int) -> str:
+    page = pdf[index]
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range().translate(_TEXT_FIXUPS)
+    finally:
+        textpage.close()
+        page.close()
+
+def _extract_page_range(pdf_path: str, start: int, stop: int) -> List[str]:
+    # Runs in a worker process: open the PDF once per range, not once per page
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        return [_page_text(pdf, i) for i in range(start, stop)]
+    finally:
+        pdf.close()
+
+def extract_pages(
+    pdf_path: str,
+    executor: ProcessPoolExecutor | None = None,
+    max_workers: int | None = None,
+) -> List[dict]:
+    """executor を渡すとそのプールを使う（渡さなければ呼び出しごとに作成）"""
+    texts: List[str] | None = None
+    with _PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            n = len(pdf)
+            workers = min(max_workers or os.cpu_count() or 1, n)
+            if n < PARALLEL_MIN_PAGES or workers <= 1:
+                texts = [_page_text(pdf, i) for i in range(n)]
+        finally:
+            pdf.close()
+
+    # 並列抽出はワーカープロセス側で PDFium を使うので、ロックは離して待つ（他の ingest を止めない）
+    if texts is None:
+        if executor is not None:
+            texts = _extract_parallel(executor, pdf_path, n, workers)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                texts = _extract_parallel(pool, pdf_path, n, workers)
+
+    return [{"page": i, "text": text} for i, text in enumerate(texts, start=1)]
+
+def _extract_parallel(pool: ProcessPoolExecutor, pdf_path: str, n: int, workers: int) -> List[str]:
+    step = -(-n // workers)
+    futures = [
+        pool.submit(_extract_page_range, pdf_path, start, min(start + step, n))
+        for start in range(0, n, step)
+    ]
+    return [t for f in futures for t in f.result()]
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 150) -> List[str]:
-    text = text or ""
-    if not text.strip():
+    # 空白のみ判定は isspace で (strip だとページ全体のコピーを作ってから捨てる)
+    if not text or text.isspace():
         return []
 
     chunks: List[str] = []
+    n = len(text)
     step = max(1, chunk_size - overlap)
-    for start in range(0, len(text), step):
+    # 反復は窓の数（≈ n / step）だけで、文字単位の処理はスライス / strip の C 実装側。
+    # 拡張モジュール (Cython 等) にしても削れるのはこの数回分のループだけなので Python のままにしている
+    for start in range(0, n, step):
         end = start + chunk_size
+        # 端に空白がなければ strip は同じ str を返すので、コピーはスライスの1回だけ
         chunk = text[start:end].strip()
         if chunk:
             chunks.append(chunk)
-        if end >= len(text):
+        if end >= n:
             break
     return chunks
 
@@ -30,9 +92,9 @@ def pages_to_chunks(pages: List[dict], chunk_size: int = 1000, overlap: int = 15
     pages: [{"page": 1, "text": "..."}]
     return: [{"page": 1, "chunk_index": 0, "text": "..."}, ...]
     """
-    out: List[dict] = []
-    for p in pages:
-        page_no = p["page"]
-        for idx, ch in enumerate(chunk_text(p.get("text", ""), chunk_size, overlap)):
-            out.append({"page": page_no, "chunk_index": idx, "text": ch})
-    return out
\ No newline at end of file
+    # ページ単位のチャンク化は数 µs/ページ。プロセスプールに渡すと pickle/IPC の方が重いので直列で行う
+    return [
+        {"page": p["page"], "chunk_index": idx, "text": ch}
+        for p in pages
+        for idx, ch in enumerate(chunk_text(p.get("text", ""), chunk_size, overlap))
+    ]
\ No newline at end of file
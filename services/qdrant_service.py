@@ -1,10 +1,28 @@
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance, PointStruct
-from qdrant_client.models import Filter, FieldCondition, MatchValue
+import asyncio
+
+import numpy as np
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client.models import VectorParams, Distance, Batch
+from qdrant_client.models import Filter, FieldCondition, FilterSelector, HasIdCondition, MatchValue
+from qdrant_client.models import Direction, OrderBy, PayloadSchemaType
+from qdrant_client.models import (
+    QuantizationSearchParams,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SearchParams,
+)
+
+# source: facet / filtered delete, ingested_at: order_by (latest ingest)
+PAYLOAD_INDEXES = {
+    "source": PayloadSchemaType.KEYWORD,
+    "ingested_at": PayloadSchemaType.DATETIME,
+}
 
 def create_qdrant_client(mode: str, url: str | None, api_key: str | None, path: str | None) -> tuple[QdrantClient, str]:
     if mode == "cloud":
-        client = QdrantClient(url=url, api_key=api_key)
+        # gRPC: vectors travel as packed float32 instead of JSON number text
+        client = QdrantClient(url=url, api_key=api_key, prefer_grpc=True)
         return client, "cloud"
 
     # local
@@ -14,12 +32,32 @@ def create_qdrant_client(mode: str, url: str | None, api_key: str | None, path:
         client = QdrantClient(path=path)
     return client, "local"
 
-def ensure_collection(client: QdrantClient, collection_name: str, vector_size: int) -> None:
+def create_async_qdrant_client(mode: str, url: str | None, api_key: str | None) -> AsyncQdrantClient | None:
+    # Local mode locks the storage folder (and ":memory:" is per-instance),
+    # so a second client cannot share it. Only cloud mode gets an async client.
+    if mode != "cloud":
+        return None
+    return AsyncQdrantClient(url=url, api_key=api_key, prefer_grpc=True)
+
+def ensure_collection(
+    client: QdrantClient,
+    collection_name: str,
+    vector_size: int,
+    *,
+    payload_indexes: bool = True,
+) -> None:
+    """payload_indexes=False for local mode (the local client ignores payload indexes and reports none)."""
     if not client.collection_exists(collection_name):
         client.create_collection(
             collection_name=collection_name,
             vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE),
+            # int8 scalar quantization: 4x less RAM for the HNSW search, originals kept for rescoring
+            quantization_config=ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=0.99, always_ram=True),
+            ),
         )
+        if payload_indexes:
+            ensure_payload_indexes(client, collection_name, existing={})
         return
 
     info = client.get_collection(collection_name)
@@ -30,46 +68,127 @@ def ensure_collection(client: QdrantClient, collection_name: str, vector_size: i
             f"but embedding dim is {vector_size}. "
             f"Use a new collection name or delete/recreate the collection."
         )
+    if payload_indexes:
+        ensure_payload_indexes(client, collection_name, existing=info.payload_schema)
+
+def ensure_payload_indexes(client: QdrantClient, collection_name: str, existing: dict | None = None) -> None:
+    if existing is None:
+        existing = client.get_collection(collection_name).payload_schema
+    for field, schema in PAYLOAD_INDEXES.items():
+        if field not in existing:
+            client.create_payload_index(collection_name, field, field_schema=schema)
 
 def delete_by_source(
     client: QdrantClient,
     collection_name: str,
     source: str,
+    keep_ids: list[int] | None = None,
 ) -> None:
+    """Delete the points of `source`, except keep_ids (used to drop stale chunks after a re-ingest)."""
+    # keep_ids=[] を「全削除」として扱うと、テキストの取れない PDF の再 ingest で source が空になる
+    if keep_ids is not None and not keep_ids:
+        raise ValueError("keep_ids is empty; pass None to delete every point of the source")
     flt = Filter(
         must=[
             FieldCondition(
                 key="source",
                 match=MatchValue(value=source),
             )
-        ]
+        ],
+        must_not=[HasIdCondition(has_id=keep_ids)] if keep_ids is not None else None,
     )
-    client.delete(collection_name=collection_name, points_selector=flt, wait=True)
+    # サーバー側で filter 削除 (scroll で ID を集めない。source は KEYWORD index 済み)
+    client.delete(
+        collection_name=collection_name,
+        points_selector=FilterSelector(filter=flt),
+        wait=True,
+    )
+
+# 1536 次元 float32 + payload(≤800文字) で 1 バッチ ≒ 2MB。gRPC のメッセージ上限には十分収まる
+UPSERT_BATCH_SIZE = 256
 
 def upsert_chunks(
     client: QdrantClient,
     collection_name: str,
-    ids: list[str],
-    vectors: list[list[float]],
+    ids: list[int],
+    vectors: np.ndarray | list[list[float]],
+    payloads: list[dict],
+    *,
+    batch_size: int = UPSERT_BATCH_SIZE,
+) -> None:
+    arr = np.asarray(vectors, dtype=np.float32)
+    n = len(ids)
+    for start in range(0, n, batch_size):
+        end = start + batch_size
+        client.upsert(
+            collection_name=collection_name,
+            points=Batch(ids=ids[start:end], vectors=arr[start:end].tolist(), payloads=payloads[start:end]),
+            # Only the last batch waits; updates are applied in order, so the rest are applied too
+            wait=end >= n,
+        )
+
+async def upsert_chunks_async(
+    client: AsyncQdrantClient,
+    collection_name: str,
+    ids: list[int],
+    vectors: np.ndarray | list[list[float]],
     payloads: list[dict],
+    *,
+    batch_size: int = UPSERT_BATCH_SIZE,
+    max_concurrent: int = 2,
 ) -> None:
-    points = [
-        PointStruct(id=ids[i], vector=vectors[i], payload=payloads[i])
-        for i in range(len(ids))
-    ]
-    client.upsert(collection_name=collection_name, points=points)
+    arr = np.asarray(vectors, dtype=np.float32)
+    starts = list(range(0, len(ids), batch_size))
+    if not starts:
+        return
+
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def _upsert(start: int, wait: bool) -> None:
+        end = start + batch_size
+        async with sem:
+            await client.upsert(
+                collection_name=collection_name,
+                points=Batch(ids=ids[start:end], vectors=arr[start:end].tolist(), payloads=payloads[start:end]),
+                wait=wait,
+            )
+
+    # Send every batch but the last without waiting, then wait on the last one
+    # so the call returns only after all points are applied.
+    await asyncio.gather(*(_upsert(start, wait=False) for start in starts[:-1]))
+    await _upsert(starts[-1], wait=True)
+
+def list_sources(client: QdrantClient, collection_name: str, limit: int = 1000) -> list[str]:
+    res = client.facet(collection_name=collection_name, key="source", limit=limit)
+    return [h.value for h in res.hits if isinstance(h.value, str) and h.value]
+
+def latest_ingested_at(client: QdrantClient, collection_name: str) -> str | None:
+    points, _ = client.scroll(
+        collection_name=collection_name,
+        limit=1,
+        order_by=OrderBy(key="ingested_at", direction=Direction.DESC),
+        with_payload=["ingested_at"],
+        with_vectors=False,
+    )
+    if not points:
+        return None
+    ts = (points[0].payload or {}).get("ingested_at")
+    return ts if isinstance(ts, str) and ts else None
 
 def search_similar(
     client: QdrantClient,
     collection_name: str,
-    query_vector: list[float],
+    query_vector: np.ndarray | list[float],
     top_k: int,
 ) -> list[dict]:
     res = client.query_points(
         collection_name=collection_name,
         query=query_vector,
         limit=top_k,
-        with_payload=True,
+        # search on the quantized vectors, then rescore the top 2x candidates with full precision
+        search_params=SearchParams(quantization=QuantizationSearchParams(rescore=True, oversampling=2.0)),
+        # only the fields built into hits below
+        with_payload=["source", "page", "text"],
         with_vectors=False,
     )
 
@@ -1,10 +1,14 @@
 import os
 import json
-import time
+import asyncio
+import hashlib
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Tuple, Optional
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Optional
 
-import requests
+import httpx
+import orjson
+from diskcache import Cache
 
 
 API_BASE = os.getenv("API_BASE", "http://localhost:8000")
@@ -25,17 +29,56 @@ DEBUG_RETURN_EVIDENCE = os.getenv("DEBUG_RETURN_EVIDENCE", "1") == "1"
 # token節約：evidenceテキストは短縮してjudgeに渡す
 EVIDENCE_TEXT_MAX = int(os.getenv("EVIDENCE_TEXT_MAX", "700"))
 JUDGE_TIMEOUT_SEC = int(os.getenv("JUDGE_TIMEOUT_SEC", "120"))
+# judge 結果のディスクキャッシュ（同じ入力なら再実行でも API を呼ばない）。空文字で無効
+JUDGE_CACHE_DIR = os.getenv("JUDGE_CACHE_DIR", ".cache/judge")
 
+# 同時に投げるリクエスト数と、1リクエストにまとめるケース数（サーバ側の上限は 32）
+# EVAL_BATCH_SIZE=1 なら /api/query を1件ずつ叩く（フロントエンドと同じ単発の分類プロンプトを評価）
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "16"))
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", "8"))
+# サーバ側 QueryBatchRequest の上限（main.MAX_BATCH_QUERIES）。超えると全バッチが 422 になる
+MAX_EVAL_BATCH_SIZE = 32
+# 出力 JSONL をまとめて書き込む行数
+OUT_FLUSH_ROWS = 32
 
-def load_jsonl(path: str) -> List[Dict[str, Any]]:
-    cases = []
-    with open(path, "r", encoding="utf-8") as f:
+QueryResult = Tuple[bool, Dict[str, Any], str, int]
+JudgeResult = Tuple[bool, Optional[Dict[str, Any]], str]
+
+# 同一ラン内の judge 呼び出し（入力ハッシュ → Task）。同じ入力は1回だけ API に投げて結果を共有する
+_JUDGE_TASKS: Dict[str, "asyncio.Task[JudgeResult]"] = {}
+
+# 一時的なエラーは指数バックオフで再試行（0.5s, 1s, 2s）
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def iter_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    # 1行ずつ orjson でパース（ファイル全体を文字列/リストに展開しない）
+    with open(path, "rb") as f:
         for line in f:
             line = line.strip()
-            if not line:
-                continue
-            cases.append(json.loads(line))
-    return cases
+            if line:
+                yield orjson.loads(line)
+
+
+async def post_with_retry(client: httpx.AsyncClient, url: str, **kwargs: Any) -> httpx.Response:
+    attempt = 0
+    while True:
+        try:
+            r = await client.post(url, **kwargs)
+            if r.status_code not in RETRY_STATUSES or attempt >= MAX_RETRIES:
+                return r
+        except httpx.TransportError:
+            if attempt >= MAX_RETRIES:
+                raise
+        await asyncio.sleep(0.5 * 2**attempt)
+        attempt += 1
+
+
+def iter_batches(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    it = iter(items)
+    while batch := list(islice(it, size)):
+        yield batch
 
 
 def jaccard(a: List[str], b: List[str]) -> float:
@@ -48,15 +91,11 @@ def jaccard(a: List[str], b: List[str]) -> float:
 
 
 def truncate(text: str, max_len: int) -> str:
-    if text is None:
-        return ""
-    t = str(text)
-    if len(t) <= max_len:
-        return t
-    return t[:max_len] + "…"
+    t = "" if text is None else str(text)
+    return t if len(t) <= max_len else t[:max_len] + "…"
 
 
-def query_api(question: str, top_k: int) -> Tuple[bool, Dict[str, Any], str, int]:
+async def query_api(client: httpx.AsyncClient, question: str, top_k: int) -> QueryResult:
     url = f"{API_BASE}/api/query"
     payload = {
         "question": question,
@@ -65,11 +104,11 @@ def query_api(question: str, top_k: int) -> Tuple[bool, Dict[str, Any], str, int
         "debug_return_evidence": DEBUG_RETURN_EVIDENCE,
     }
     try:
-        r = requests.post(url, json=payload, timeout=120)
+        r = await post_with_retry(client, url, json=payload, timeout=120)
     except Exception as e:
         return False, {}, f"request_error: {e}", 0
 
-    if not r.ok:
+    if not r.is_success:
         return False, {}, r.text, r.status_code
 
     try:
@@ -78,7 +117,42 @@ def query_api(question: str, top_k: int) -> Tuple[bool, Dict[str, Any], str, int
         return False, {}, f"json_parse_error: {e}\nraw={r.text[:5000]}", r.status_code
 
 
-def call_openai_responses_json_schema(
+async def query_api_batch(
+    client: httpx.AsyncClient, questions: List[str], top_k: int
+) -> List[QueryResult]:
+    """
+    /api/query/batch に複数の質問をまとめて投げる（サーバ側でカテゴリ分類が1回の LLM 呼び出しになる）。
+    リクエスト自体が失敗した場合は全ケース同じエラーを返す。
+    """
+    url = f"{API_BASE}/api/query/batch"
+    payload = {
+        "queries": [
+            {
+                "question": question,
+                "top_k": top_k,
+                # 評価時のみ：カテゴリ0件でも evidence を返して原因切り分け
+                "debug_return_evidence": DEBUG_RETURN_EVIDENCE,
+            }
+            for question in questions
+        ]
+    }
+    try:
+        r = await post_with_retry(client, url, json=payload, timeout=120)
+    except Exception as e:
+        return [(False, {}, f"request_error: {e}", 0)] * len(questions)
+
+    if not r.is_success:
+        return [(False, {}, r.text, r.status_code)] * len(questions)
+
+    try:
+        results = r.json()["results"]
+    except Exception as e:
+        return [(False, {}, f"json_parse_error: {e}\nraw={r.text[:5000]}", r.status_code)] * len(questions)
+    return [(True, data, "", r.status_code) for data in results]
+
+
+async def call_openai_responses_json_schema(
+    client: httpx.AsyncClient,
     api_key: str,
     model: str,
     instructions: str,
@@ -113,50 +187,38 @@ def call_openai_responses_json_schema(
     }
 
     try:
-        r = requests.post(url, headers=headers, json=body, timeout=timeout_sec)
+        r = await post_with_retry(client, url, headers=headers, json=body, timeout=timeout_sec)
     except Exception as e:
         return False, None, f"judge_request_error: {e}"
 
-    if not r.ok:
+    if not r.is_success:
         return False, None, f"judge_http_error: {r.status_code}\n{r.text}"
 
+    # strict json_schema なので message の output_text がそのまま schema どおりの JSON
+    # （拒否 / 出力なし / 壊れた JSON はすべてここで judge_extract_error）
     try:
-        data = r.json()
-    except Exception as e:
-        return False, None, f"judge_json_parse_error: {e}\nraw={r.text[:3000]}"
-
-    # Responses APIは output_text があるのでまずそれを優先
-    try:
-        out_text = data.get("output_text")
-        if isinstance(out_text, str) and out_text.strip():
-            parsed = json.loads(out_text)
-            return True, parsed, ""
-    except Exception:
-        pass
-
-    # フォールバック：output 配列から text を集める
-    try:
-        parts: List[str] = []
-        for item in data.get("output", []) or []:
-            for c in item.get("content", []) or []:
-                if isinstance(c, dict) and "text" in c and isinstance(c["text"], str):
-                    parts.append(c["text"])
-        joined = "".join(parts).strip()
-        if not joined:
-            return False, None, f"judge_no_text_output: {json.dumps(data)[:2000]}"
-        parsed = json.loads(joined)
-        return True, parsed, ""
+        data = orjson.loads(r.content)
+        out_text = next(
+            c["text"]
+            for item in data.get("output") or []
+            if item.get("type") == "message"
+            for c in item.get("content") or []
+            if c.get("type") == "output_text"
+        )
+        return True, orjson.loads(out_text), ""
     except Exception as e:
-        return False, None, f"judge_extract_error: {e}\nresp={json.dumps(data)[:3000]}"
+        return False, None, f"judge_extract_error: {e!r}\nresp={r.text[:3000]}"
 
 
-def judge_case(
+async def judge_case(
+    client: httpx.AsyncClient,
     question: str,
     expected_categories: List[str],
     got_categories: List[str],
     answer: str,
     evidence: List[Dict[str, Any]],
-) -> Tuple[bool, Optional[Dict[str, Any]], str]:
+    cache: Optional[Cache] = None,
+) -> JudgeResult:
     """
     Returns judge scores as dict:
       retrieval_relevance: 0-5
@@ -168,16 +230,15 @@ def judge_case(
         return False, None, "OPENAI_API_KEY is not set"
 
     # evidenceを短縮して渡す（コスト/速度安定）
-    ev_slim = []
-    for e in (evidence or []):
-        ev_slim.append(
-            {
-                "source": e.get("source"),
-                "page": e.get("page"),
-                "score": e.get("score"),
-                "text": truncate(e.get("text", ""), EVIDENCE_TEXT_MAX),
-            }
-        )
+    ev_slim = [
+        {
+            "source": e.get("source"),
+            "page": e.get("page"),
+            "score": e.get("score"),
+            "text": truncate(e.get("text", ""), EVIDENCE_TEXT_MAX),
+        }
+        for e in (evidence or [])
+    ]
 
     # 0-5採点のJSON Schema
     schema = {
@@ -218,24 +279,129 @@ def judge_case(
         ensure_ascii=False,
     )
 
-    return call_openai_responses_json_schema(
-        api_key=OPENAI_API_KEY,
-        model=OPENAI_JUDGE_MODEL,
-        instructions=instructions,
-        input_text=input_text,
-        schema_name="rag_eval_scores",
-        schema=schema,
-        timeout_sec=JUDGE_TIMEOUT_SEC,
-    )
+    key = hashlib.sha256(f"{OPENAI_JUDGE_MODEL}\0{instructions}\0{input_text}".encode("utf-8")).hexdigest()
+    # diskcache は SQLite へのブロッキング I/O なのでスレッドで（イベントループを止めない）
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return True, cached, ""
+
+    async def _judge() -> JudgeResult:
+        result = await call_openai_responses_json_schema(
+            client,
+            api_key=OPENAI_API_KEY,
+            model=OPENAI_JUDGE_MODEL,
+            instructions=instructions,
+            input_text=input_text,
+            schema_name="rag_eval_scores",
+            schema=schema,
+            timeout_sec=JUDGE_TIMEOUT_SEC,
+        )
+        j_ok, j_data, _ = result
+        # 成功した採点だけ保存（エラーは次回再試行）
+        if cache is not None and j_ok and j_data:
+            await asyncio.to_thread(cache.set, key, j_data)
+        return result
+
+    task = _JUDGE_TASKS.get(key)
+    if task is None:
+        task = _JUDGE_TASKS[key] = asyncio.create_task(_judge())
+    return await task
+
+
+async def evaluate_case(
+    judge_client: httpx.AsyncClient,
+    judge_cache: Optional[Cache],
+    i: int,
+    c: Dict[str, Any],
+    result: QueryResult,
+    ts: str,
+) -> Dict[str, Any]:
+    qid = c.get("id", f"row{i:03d}")
+    question = c["question"]
+    expected = c.get("expected_categories", [])
+    ok, data, err, status = result
+
+    got_categories = []
+    got_evidence = []
+    answer = ""
+
+    if ok:
+        answer = str(data.get("answer", ""))
+        got_categories = data.get("categories") or []
+        got_evidence = data.get("evidence") or []
+
+    cat_sim = jaccard(expected, got_categories) if ok else 0.0
+    has_ev = bool(got_evidence) if ok else False
+
+    judge = None
+    judge_error = None
+    if ENABLE_JUDGE and ok:
+        j_ok, j_data, j_err = await judge_case(
+            judge_client,
+            question=question,
+            expected_categories=expected,
+            got_categories=got_categories,
+            answer=answer,
+            evidence=got_evidence,
+            cache=judge_cache,
+        )
+        if j_ok and j_data:
+            judge = j_data
+        else:
+            judge_error = j_err
+
+    return {
+        "id": qid,
+        "timestamp_utc": ts,
+        "top_k": TOP_K,
+        "question": question,
+        "expected_categories": expected,
+        "ok": ok,
+        "http_status": status,
+        "error": err if not ok else None,
+        "response": data if ok else None,
+        "metrics": {
+            "category_jaccard": cat_sim,
+            "evidence_nonempty": has_ev,
+        },
+        "judge": judge,
+        "judge_error": judge_error,
+    }
+
+
+async def process_batch(
+    api_client: httpx.AsyncClient,
+    judge_client: httpx.AsyncClient,
+    judge_cache: Optional[Cache],
+    sem: asyncio.Semaphore,
+    batch: List[Tuple[int, Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    async with sem:
+        if EVAL_BATCH_SIZE == 1:
+            results = [await query_api(api_client, c["question"], TOP_K) for _, c in batch]
+        else:
+            results = await query_api_batch(api_client, [c["question"] for _, c in batch], TOP_K)
+        ts = datetime.now(timezone.utc).isoformat()
+        # judge はケースごとに並行
+        return await asyncio.gather(
+            *(evaluate_case(judge_client, judge_cache, i, c, result, ts) for (i, c), result in zip(batch, results))
+        )
 
 
-def main():
-    cases = load_jsonl(CASES_PATH)
-    print(f"Loaded {len(cases)} cases from {CASES_PATH}")
+async def main():
+    if not 1 <= EVAL_BATCH_SIZE <= MAX_EVAL_BATCH_SIZE:
+        raise SystemExit(
+            f"EVAL_BATCH_SIZE must be between 1 and {MAX_EVAL_BATCH_SIZE} "
+            f"(the /api/query/batch limit), got {EVAL_BATCH_SIZE}"
+        )
+
+    print(f"Reading cases from {CASES_PATH}")
     print(f"API_BASE={API_BASE} TOP_K={TOP_K}")
     print(f"Writing outputs to {OUT_PATH}")
     print(f"DEBUG_RETURN_EVIDENCE={DEBUG_RETURN_EVIDENCE}")
     print(f"ENABLE_JUDGE={ENABLE_JUDGE} JUDGE_MODEL={OPENAI_JUDGE_MODEL}")
+    print(f"EVAL_CONCURRENCY={EVAL_CONCURRENCY} EVAL_BATCH_SIZE={EVAL_BATCH_SIZE}")
 
     n_ok = 0
     cat_scores: List[float] = []
@@ -245,84 +411,75 @@ def main():
     judge_ground: List[int] = []
     judge_cat: List[int] = []
 
-    with open(OUT_PATH, "w", encoding="utf-8") as out:
-        for i, c in enumerate(cases, start=1):
-            qid = c.get("id", f"row{i:03d}")
-            question = c["question"]
-            expected = c.get("expected_categories", [])
-
-            ok, data, err, status = query_api(question, TOP_K)
-            ts = datetime.now(timezone.utc).isoformat()
-
-            got_categories = []
-            got_evidence = []
-            answer = ""
-
-            if ok:
-                answer = str(data.get("answer", ""))
-                got_categories = data.get("categories") or []
-                got_evidence = data.get("evidence") or []
-
-            cat_sim = jaccard(expected, got_categories) if ok else 0.0
-            has_ev = bool(got_evidence) if ok else False
-
-            judge = None
-            judge_error = None
-            if ENABLE_JUDGE and ok:
-                j_ok, j_data, j_err = judge_case(
-                    question=question,
-                    expected_categories=expected,
-                    got_categories=got_categories,
-                    answer=answer,
-                    evidence=got_evidence,
-                )
-                if j_ok and j_data:
-                    judge = j_data
-                    judge_retr.append(int(j_data["retrieval_relevance"]))
-                    judge_ground.append(int(j_data["groundedness"]))
-                    judge_cat.append(int(j_data["category_correctness"]))
-                else:
-                    judge_error = j_err
-
-            row = {
-                "id": qid,
-                "timestamp_utc": ts,
-                "top_k": TOP_K,
-                "question": question,
-                "expected_categories": expected,
-                "ok": ok,
-                "http_status": status,
-                "error": err if not ok else None,
-                "response": data if ok else None,
-                "metrics": {
-                    "category_jaccard": cat_sim,
-                    "evidence_nonempty": has_ev,
-                },
-                "judge": judge,
-                "judge_error": judge_error,
-            }
-            out.write(json.dumps(row, ensure_ascii=False) + "\n")
-
-            if ok:
-                n_ok += 1
-                cat_scores.append(cat_sim)
-                if has_ev:
-                    evidence_nonempty += 1
-
-            # 進捗表示
-            msg = f"[{i}/{len(cases)}] {qid} ok={ok} cat_jacc={cat_sim:.2f} evidence={has_ev}"
-            if ENABLE_JUDGE and ok:
-                if judge:
-                    msg += (
-                        f" judge(retr={judge['retrieval_relevance']},"
-                        f" grd={judge['groundedness']},"
-                        f" cat={judge['category_correctness']})"
-                    )
-                else:
-                    msg += " judge=ERR"
-            print(msg)
-
-            time.sleep(0.05)
+    # 同時実行数はセマフォで制御（固定 sleep によるペーシングは不要）
+    sem = asyncio.Semaphore(EVAL_CONCURRENCY)
+    # keep-alive の接続プールを全ケースで共有（接続失敗は transport 側でも再試行）
+    limits = httpx.Limits(max_connections=EVAL_CONCURRENCY, max_keepalive_connections=EVAL_CONCURRENCY)
+    api_transport = httpx.AsyncHTTPTransport(limits=limits, retries=MAX_RETRIES)
+    # judge (OpenAI) は HTTP/2：同時の judge 呼び出しを1本の TLS 接続に多重化
+    judge_transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+        retries=MAX_RETRIES,
+    )
+
+    judge_cache = Cache(JUDGE_CACHE_DIR) if JUDGE_CACHE_DIR else None
+
+    async with (
+        httpx.AsyncClient(transport=api_transport) as api_client,
+        httpx.AsyncClient(transport=judge_transport, timeout=JUDGE_TIMEOUT_SEC) as judge_client,
+    ):
+        with open(OUT_PATH, "wb") as out:
+            batches = list(iter_batches(enumerate(iter_jsonl(CASES_PATH), start=1), EVAL_BATCH_SIZE))
+            n_cases = sum(len(b) for b in batches)
+            print(f"Loaded {n_cases} cases")
+            tasks = [process_batch(api_client, judge_client, judge_cache, sem, b) for b in batches]
+            # 完了順に書き出す（行の順序は入力順と一致しない。id で突き合わせる）
+            done = 0
+            buf: List[bytes] = []
+            try:
+                for fut in asyncio.as_completed(tasks):
+                    for row in await fut:
+                        done += 1
+                        # 書き込みはこのループ（単一コルーチン）だけが行うのでロック不要。
+                        # OUT_FLUSH_ROWS 行ごとにまとめて書く（残りは finally で書き出す）
+                        buf.append(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+                        if len(buf) >= OUT_FLUSH_ROWS:
+                            out.write(b"".join(buf))
+                            buf.clear()
+
+                        ok = row["ok"]
+                        cat_sim = row["metrics"]["category_jaccard"]
+                        has_ev = row["metrics"]["evidence_nonempty"]
+                        judge = row["judge"]
+
+                        if ok:
+                            n_ok += 1
+                            cat_scores.append(cat_sim)
+                            if has_ev:
+                                evidence_nonempty += 1
+                        if judge:
+                            judge_retr.append(int(judge["retrieval_relevance"]))
+                            judge_ground.append(int(judge["groundedness"]))
+                            judge_cat.append(int(judge["category_correctness"]))
+
+                        # 進捗表示
+                        msg = f"[{done}/{n_cases}] {row['id']} ok={ok} cat_jacc={cat_sim:.2f} evidence={has_ev}"
+                        if ENABLE_JUDGE and ok:
+                            if judge:
+                                msg += (
+                                    f" judge(retr={judge['retrieval_relevance']},"
+                                    f" grd={judge['groundedness']},"
+                                    f" cat={judge['category_correctness']})"
+                                )
+                            else:
+                                msg += " judge=ERR"
+                        print(msg)
+            finally:
+                out.write(b"".join(buf))
+
+    if judge_cache is not None:
+        judge_cache.close()
 
     # 集計
     avg_cat = sum(cat_scores) / len(cat_scores) if cat_scores else 0.0
@@ -332,7 +489,7 @@ def main():
         return (sum(xs) / len(xs)) if xs else 0.0
 
     print("\n=== Summary ===")
-    print(f"Total cases: {len(cases)}")
+    print(f"Total cases: {n_cases}")
     print(f"OK responses: {n_ok}")
     print(f"Avg category jaccard: {avg_cat:.3f}")
     print(f"Evidence non-empty rate: {ev_rate:.3f}")
@@ -345,4 +502,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())